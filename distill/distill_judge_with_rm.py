@@ -1,61 +1,34 @@
 import json
-import re
+import os
+from collections import deque
+from multiprocessing import Pool
 
-def remove_templates(text):
-    """移除模板标记，例如<|...|>"""
-    return re.sub(r'<\|.*?\|>', '', text).strip()
-
-def process_file(input_filename, output_filename):
-    output_data = []
-    toggle = True  # 初始化切换标志
-
-    with open(input_filename, 'r', encoding='utf-8') as infile:
-        for line_number, line in enumerate(infile, 1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError:
-                print(f"行 {line_number} 无效 JSON，已跳过: {line}")
-                continue
-
-            # 提取 instruction
-            prompt = data.get('prompt', '')
-            instruction_match = re.search(
-                r'<\|start_header_id\|>user<\|end_header_id\|>\n\n(.*?)<\|eot_id\|>',
-                prompt,
-                re.DOTALL
-            )
-            if instruction_match:
-                instruction = remove_templates(instruction_match.group(1))
-            else:
-                instruction = ''
-
-            # 处理 chosen 和 rejected
-            chosen_text = remove_templates(data.get('chosen', ''))
-            rejected_text = remove_templates(data.get('rejected', ''))
-
-            # 根据 results 字段确定是否需要交换 chosen 和 rejected
-            if data.get('results', 1) == 0:
-                chosen_text, rejected_text = rejected_text, chosen_text
-
-            # 根据 toggle 决定输出标签和文本内容的对应关系
-            if toggle:
-                output_label = "Output (a)"
-                a_text = chosen_text
-                b_text = rejected_text
-            else:
-                output_label = "Output (b)"
-                a_text = rejected_text
-                b_text = chosen_text
-
-            # 设置 output 字段
-            output = output_label
-
-            # 创建新的数据条目
-            output_entry = {
-                "instruction": f"""Select the Output (a) or Output (b) that is better for the given instruction. The two outputs are generated by two different AI chatbots respectively.
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时回退到标准库 json
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# 按字节读取输入时使用的缓冲区大小（1 MiB），减少 read 系统调用
+_READ_BUFFER_SIZE = 1 << 20
+
+# 每个子进程任务处理的行数，用于摊薄进程间通信开销
+_BATCH_SIZE = 10000
+
+# user 段的起止标记均为固定字面量，直接用 str.find 定位
+_USER_TAG = '<|start_header_id|>user<|end_header_id|>\n\n'
+_EOT = '<|eot_id|>'
+
+# 评测指令模板，只需在每条数据上填入 instruction 与两个输出
+_INSTR_TEMPLATE = """Select the Output (a) or Output (b) that is better for the given instruction. The two outputs are generated by two different AI chatbots respectively.
 
 Here are some rules of the evaluation:
 (1) You should prioritize evaluating whether the output honestly/precisely/closely executes the instruction, then consider its helpfulness, accuracy, level of detail, harmlessness, etc.
@@ -70,27 +43,139 @@ You should answer using ONLY "Output (a)" or "Output (b)". Do NOT output any oth
 {instruction}
 
 # Output (a):
-{a_text}
+{a}
 
 # Output (b):
-{b_text}
+{b}
+
+# Which is better, Output (a) or Output (b)? Your response should be either "Output (a)" or "Output (b)":"""
 
-# Which is better, Output (a) or Output (b)? Your response should be either "Output (a)" or "Output (b)":""",
-                "input": "",
+_SYSTEM_PROMPT = "You are a helpful assistant in evaluating the quality of the outputs for a given instruction. Your goal is to select the best output for the given instruction."
 
-                "system": "You are a helpful assistant in evaluating the quality of the outputs for a given instruction. Your goal is to select the best output for the given instruction.",
-                "output": output
-            }
-            output_data.append(output_entry)
+def _escape(text):
+    """JSON 转义字符串内容（不含两侧引号）"""
+    return _json_dumps(text)[1:-1]
 
-            # 切换 toggle 标志，以便下一个条目时交换
-            toggle = not toggle
+# 模板与其余字段都是常量，预先序列化为 JSON 片段，每条数据只需转义三段变量文本再拼接
+_prefix, _rest = _INSTR_TEMPLATE.split('{instruction}')
+_mid_a, _rest = _rest.split('{a}')
+_mid_b, _tail = _rest.split('{b}')
+_ENTRY_PREFIX = b'{"instruction":"' + _escape(_prefix)
+_ENTRY_MID_A = _escape(_mid_a)
+_ENTRY_MID_B = _escape(_mid_b)
+_ENTRY_SUFFIX = {
+    output: _escape(_tail) + b'",'
+    + _json_dumps({"input": "", "system": _SYSTEM_PROMPT, "output": output})[1:] + b'\n'
+    for output in ("Output (a)", "Output (b)")
+}
 
-    # 将结果写入输出文件
-    with open(output_filename, 'w', encoding='utf-8') as outfile:
-        for entry in output_data:
-            json_line = json.dumps(entry, ensure_ascii=False)
-            outfile.write(json_line + '\n')
+def remove_templates(text):
+    """移除模板标记，例如<|...|>"""
+    # 逐段 str.find 扫描，等价于 re.sub(r'<\|.*?\|>', '', text)
+    out = []
+    i = 0
+    while True:
+        j = text.find('<|', i)
+        if j < 0:
+            out.append(text[i:])
+            break
+        k = text.find('|>', j + 2)
+        if k < 0:
+            out.append(text[i:])
+            break
+        # 与正则中的 '.' 一致：标记内部不能跨行
+        nl = text.find('\n', j + 2, k)
+        if nl >= 0:
+            out.append(text[i:nl])
+            i = nl
+            continue
+        out.append(text[i:j])
+        i = k + 2
+    return ''.join(out).strip()
+
+def _transform_batch(batch):
+    """转换一批非空行，返回序列化后的输出行以及无效 JSON 行"""
+    base_idx, lines = batch
+    out_lines = []
+    skipped = []
+    # 输出标签由非空行的全局序号的奇偶决定，各进程无需共享状态
+    for idx, (line_number, line) in enumerate(lines, base_idx):
+        try:
+            data = _json_loads(line)
+        except json.JSONDecodeError:
+            skipped.append((line_number, line))
+            continue
+
+        # 提取 instruction
+        prompt = data.get('prompt', '')
+        start = prompt.find(_USER_TAG)
+        end = prompt.find(_EOT, start + len(_USER_TAG)) if start >= 0 else -1
+        if end >= 0:
+            instruction = remove_templates(prompt[start + len(_USER_TAG):end])
+        else:
+            instruction = ''
+
+        # 处理 chosen 和 rejected
+        chosen_text = remove_templates(data.get('chosen', ''))
+        rejected_text = remove_templates(data.get('rejected', ''))
+
+        # 根据 results 字段确定是否需要交换 chosen 和 rejected
+        if data.get('results', 1) == 0:
+            chosen_text, rejected_text = rejected_text, chosen_text
+
+        # 根据序号奇偶决定输出标签和文本内容的对应关系
+        if idx & 1 == 0:
+            a_text, b_text, output = chosen_text, rejected_text, "Output (a)"
+        else:
+            a_text, b_text, output = rejected_text, chosen_text, "Output (b)"
+
+        # 创建新的数据条目，等价于序列化
+        # {"instruction": _INSTR_TEMPLATE.format(...), "input": "", "system": _SYSTEM_PROMPT, "output": output}
+        out_lines.append(b''.join((
+            _ENTRY_PREFIX, _escape(instruction),
+            _ENTRY_MID_A, _escape(a_text),
+            _ENTRY_MID_B, _escape(b_text),
+            _ENTRY_SUFFIX[output],
+        )))
+
+    return out_lines, skipped
+
+def _iter_batches(infile, batch_size):
+    """按 batch_size 个非空行切分输入，附带该批第一行的全局序号"""
+    base_idx = 0
+    lines = []
+    for line_number, line in enumerate(infile, 1):
+        line = line.strip()
+        if not line:
+            continue
+        lines.append((line_number, line))
+        if len(lines) == batch_size:
+            yield base_idx, lines
+            base_idx += len(lines)
+            lines = []
+    if lines:
+        yield base_idx, lines
+
+def _write_batch(outfile, result):
+    out_lines, skipped = result
+    for line_number, line in skipped:
+        print(f"行 {line_number} 无效 JSON，已跳过: {line.decode('utf-8', errors='replace')}")
+    outfile.writelines(out_lines)
+
+def process_file(input_filename, output_filename, num_workers=None, batch_size=_BATCH_SIZE):
+    num_workers = num_workers or os.cpu_count() or 1
+
+    # 多进程并行转换，按提交顺序写回；限制在途批次数，避免把整个输入读入内存
+    with open(input_filename, 'rb', buffering=_READ_BUFFER_SIZE) as infile, \
+            open(output_filename, 'wb') as outfile, \
+            Pool(num_workers) as pool:
+        pending = deque()
+        for batch in _iter_batches(infile, batch_size):
+            pending.append(pool.apply_async(_transform_batch, (batch,)))
+            if len(pending) >= 2 * num_workers:
+                _write_batch(outfile, pending.popleft().get())
+        while pending:
+            _write_batch(outfile, pending.popleft().get())
 
 if __name__ == '__main__':
     # 输入和输出文件名
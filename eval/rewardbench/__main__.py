@@ -14,23 +14,115 @@
 
 # Run RewardBench (evaluate any reward model on any dataet)
 import argparse
+import functools
+import hashlib
 import json
 import logging
 import os
+import pathlib
+import shutil
 import sys
 
+import numpy as np
 import torch
 import transformers
-from accelerate import Accelerator
+from accelerate import Accelerator, DataLoaderConfiguration
 from accelerate.logging import get_logger
+from datasets import load_from_disk
 from tqdm import tqdm
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from rewardbench import (
     REWARD_MODEL_CONFIG,
     check_tokenizer_chat_template,
     load_preference_dataset,
 )
+from rewardbench.models.pipeline import RewardBenchPipeline
+
+
+def _json_dumps(obj) -> bytes:
+    """
+    Serialize to compact JSON bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _latest_mtime(path: str) -> float:
+    """
+    Latest modification time of a file, or of the files directly inside a directory.
+    """
+    if os.path.isdir(path):
+        return max([os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path) if entry.is_file()])
+    return os.path.getmtime(path)
+
+
+def tokenized_cache_path(args, tokenizer_path: str, tokenizer) -> str:
+    """
+    Location of the cached tokenized dataset for this dataset / tokenizer / max length combination.
+    """
+    key = {
+        "dataset": args.dataset,
+        "split": args.split,
+        "load_json": args.load_json,
+        "tokenizer": tokenizer_path,
+        "max_length": args.max_length,
+        "chat_template": args.chat_template,
+        # identify the tokenizer contents, not just its name (hub revisions, add_eos_token, library version)
+        "tokenizer_class": type(tokenizer).__name__,
+        "tokenizer_commit": tokenizer.init_kwargs.get("_commit_hash"),
+        "tokenizer_vocab_size": len(tokenizer),
+        "tokenizer_add_eos_token": getattr(tokenizer, "add_eos_token", None),
+        "transformers_version": transformers.__version__,
+    }
+    # local dataset files and tokenizer directories can change in place, so include their modification time
+    if os.path.exists(args.dataset):
+        key["dataset_mtime"] = _latest_mtime(args.dataset)
+    if os.path.exists(tokenizer_path):
+        key["tokenizer_mtime"] = _latest_mtime(tokenizer_path)
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(os.path.expanduser(args.tokenized_cache_dir), digest)
+
+
+def tokenize_preference_dataset(dataset, tokenizer, max_length: int):
+    """
+    Add `input_ids_chosen` / `input_ids_rejected` columns, truncated the same way the reward pipeline does,
+    and a `length` column with the longer of the two token counts.
+    """
+
+    def tokenize(batch):
+        chosen = tokenizer(batch["text_chosen"], truncation=True, max_length=max_length)["input_ids"]
+        rejected = tokenizer(batch["text_rejected"], truncation=True, max_length=max_length)["input_ids"]
+        return {
+            "input_ids_chosen": chosen,
+            "input_ids_rejected": rejected,
+            "length": [max(len(c), len(r)) for c, r in zip(chosen, rejected)],
+        }
+
+    return dataset.map(tokenize, batched=True, desc="Tokenizing")
+
+
+def collate_preference_batch(examples, tokenizer):
+    """
+    Pad the pre-tokenized chosen then rejected sequences of a batch into one set of model inputs.
+    """
+    input_ids = [example["input_ids_chosen"] for example in examples]
+    input_ids += [example["input_ids_rejected"] for example in examples]
+    return {
+        "index": torch.tensor([example["index"] for example in examples]),
+        "text_chosen": [example["text_chosen"] for example in examples],
+        "text_rejected": [example["text_rejected"] for example in examples],
+        # plain dict rather than BatchEncoding: accelerate then moves each tensor with non_blocking=True,
+        # which BatchEncoding.to does not accept
+        "inputs": dict(tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt")),
+    }
 
 
 def main():
@@ -51,6 +143,26 @@ def main():
     # inference args
     parser.add_argument("--batch_size", type=int, default=8, help="The batch size to use.")
     parser.add_argument("--max_length", type=int, default=512, help="The max length to use.")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="The number of DataLoader workers collating batches in the background.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default=None,
+        choices=["bf16", "fp16", "int8", "nf4"],
+        help="The model precision (defaults to int8 for quantized model configs, else the model's own dtype).",
+    )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default=None,
+        choices=["eager", "sdpa", "flash_attention_2"],
+        help="The attention implementation (defaults to flash_attention_2 when available for half precision).",
+    )
 
     # system args
     parser.add_argument("--load_json", action="store_true", default=False, help="Load dataset as json.")
@@ -58,12 +170,19 @@ def main():
     parser.add_argument("--debug", action="store_true", default=False, help="Debug mode.")
     parser.add_argument("--output_dir", type=str, default="results/", help="The output directory to save results.")
     parser.add_argument("--save_all", action="store_true", default=False, help="Save all results.")
+    parser.add_argument(
+        "--tokenized_cache_dir",
+        type=str,
+        default="~/.cache/rewardbench_tok",
+        help="Where to cache the tokenized dataset between runs (empty string disables caching).",
+    )
     args = parser.parse_args()
 
     ###############
     # Setup logging
     ###############
-    accelerator = Accelerator()
+    # non-blocking host-to-device copies of (pinned) batches, so they overlap with compute
+    accelerator = Accelerator(dataloader_config=DataLoaderConfiguration(non_blocking=True))
     current_device = accelerator.process_index
 
     logger = get_logger(__name__)
@@ -119,37 +238,114 @@ def main():
     #########################
     logger.info("*** Load dataset ***")
     tokenizer_path = args.tokenizer if args.tokenizer else args.model
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=args.trust_remote_code)
-    dataset = load_preference_dataset(
-        args.dataset, split=args.split, json=args.load_json, tokenizer=tokenizer, conv=conv
+    # let the Rust tokenizer batch-encode in parallel (unless the user configured it)
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+    tokenizer = AutoTokenizer.from_pretrained(
+        tokenizer_path, use_fast=True, trust_remote_code=args.trust_remote_code
     )
+    if not tokenizer.is_fast:
+        logger.warning(f"No fast tokenizer available for {tokenizer_path}, falling back to the slow Python tokenizer")
+    # padding experiments for determinism (matches rewardbench.py)
+    tokenizer.padding_side = "left"
+
+    # if using fastchat template (no template in tokenizer), make the RM tokenizer output an EOS token
+    # (set before tokenizing so the cached input ids match what the pipeline would produce)
+    if not check_tokenizer_chat_template(tokenizer):
+        tokenizer.add_eos_token = True
+
+    cache_path = tokenized_cache_path(args, tokenizer_path, tokenizer) if args.tokenized_cache_dir else None
+    with accelerator.main_process_first():
+        dataset = None
+        if cache_path and os.path.isdir(cache_path):
+            logger.info(f"Loading tokenized dataset from {cache_path}")
+            try:
+                dataset = load_from_disk(cache_path)
+                if "length" not in dataset.column_names:
+                    raise ValueError("missing `length` column")
+            except Exception as e:
+                # unreadable or outdated cache entries are rebuilt below rather than failing every later run
+                logger.warning(f"Could not load tokenized dataset cache {cache_path}, rebuilding it: {e}")
+                dataset = None
+        if dataset is None:
+            dataset = load_preference_dataset(
+                args.dataset, split=args.split, json=args.load_json, tokenizer=tokenizer, conv=conv
+            )
+            dataset = tokenize_preference_dataset(dataset, tokenizer, args.max_length)
+            if cache_path and accelerator.is_main_process:
+                logger.info(f"Saving tokenized dataset to {cache_path}")
+                # save to a temporary sibling and rename it into place, so an interrupted save is never loaded
+                tmp_path = f"{cache_path}.tmp{os.getpid()}"
+                dataset.save_to_disk(tmp_path)
+                shutil.rmtree(cache_path, ignore_errors=True)
+                os.rename(tmp_path, cache_path)
 
     if args.debug:
         dataset = dataset.select(range(10))
 
+    # sort by token length so each batch pads to a similar length, undone after inference
+    # (longest first, so out-of-memory batch sizes fail on the first step)
+    # each example carries its original index so scores from every process can be put back in order
+    dataset = dataset.add_column("index", list(range(len(dataset))))
+    order = np.argsort(np.asarray(dataset["length"]), kind="stable")[::-1]
+    dataset = dataset.select(order)
+
     logger.info("*** Load reward model ***")
 
     ############################
     # Load classifier model pipeline
     ############################
+    # chosen and rejected texts are scored together in a single pipeline call
     reward_pipeline_kwargs = {
-        "batch_size": args.batch_size,  # eval_args.inference_batch_size,
+        "batch_size": 2 * args.batch_size,  # eval_args.inference_batch_size,
         "truncation": True,
         "padding": True,
         "max_length": args.max_length,
         "function_to_apply": "none",  # Compute raw logits
         "return_token_type_ids": False,
     }
-    if quantized:
+    precision = args.precision if args.precision else ("int8" if quantized else None)
+    logger.info(f"Loading reward model with precision: {precision}")
+    if precision == "int8":
         model_kwargs = {
             "load_in_8bit": True,
             "device_map": {"": current_device},
             "torch_dtype": torch.float16 if torch.cuda.is_available() else None,
         }
+    elif precision == "nf4":
+        model_kwargs = {
+            "quantization_config": BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            ),
+            "device_map": {"": current_device},
+            "torch_dtype": torch.bfloat16,
+        }
+    elif precision in ("bf16", "fp16"):
+        model_kwargs = {
+            "device_map": {"": current_device},
+            "torch_dtype": torch.bfloat16 if precision == "bf16" else torch.float16,
+        }
     else:
         model_kwargs = {"device_map": {"": current_device}}
 
-    model = model_builder(args.model, **model_kwargs, trust_remote_code=args.trust_remote_code)
+    # flash attention 2 needs fp16/bf16 weights; otherwise Hugging Face picks sdpa or eager itself
+    auto_flash_attn = False
+    if args.attn_implementation:
+        model_kwargs["attn_implementation"] = args.attn_implementation
+    elif model_kwargs.get("torch_dtype") in (torch.float16, torch.bfloat16) and is_flash_attn_2_available():
+        model_kwargs["attn_implementation"] = "flash_attention_2"
+        auto_flash_attn = True
+
+    try:
+        model = model_builder(args.model, **model_kwargs, trust_remote_code=args.trust_remote_code)
+    except ValueError as e:
+        # architectures without flash attention 2 support (e.g. DeBERTa, some remote code models) reject it
+        if not auto_flash_attn:
+            raise
+        logger.warning(f"Flash attention 2 not supported for {args.model}, loading with the default attention: {e}")
+        model_kwargs.pop("attn_implementation")
+        model = model_builder(args.model, **model_kwargs, trust_remote_code=args.trust_remote_code)
     reward_pipe = pipeline_builder(
         "text-classification",  # often not used
         model=model,
@@ -164,96 +360,124 @@ def main():
     if reward_pipe.model.config.pad_token_id is None:
         reward_pipe.model.config.pad_token_id = reward_pipe.tokenizer.pad_token_id
 
-    # if using fastchat template (no template in tokenizer), make the RM tokenizer output an EOS token
-    if not check_tokenizer_chat_template(tokenizer):
-        reward_pipe.tokenizer.add_eos_token = True
-
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=args.batch_size,
         shuffle=False,
         drop_last=False,
+        collate_fn=functools.partial(collate_preference_batch, tokenizer=tokenizer),
+        num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=args.num_workers > 0,
+        prefetch_factor=4 if args.num_workers > 0 else None,
     )
 
     dataloader, model = accelerator.prepare(dataloader, reward_pipe.model)
+    # bitsandbytes-quantized layers do not compile, so only compile full/half precision models
+    # (no CUDA graphs: length-sorted batches change shape almost every step, so graphs would be re-recorded)
+    if torch.cuda.is_available() and precision not in ("int8", "nf4"):
+        model = torch.compile(model, fullgraph=False, dynamic=True)
     reward_pipe.model = model
 
     ############################
     # Run inference
     ############################
 
-    results = []
-    scores_chosen = []
-    scores_rejected = []
-    for step, batch in enumerate(tqdm(dataloader, desc="RM batch steps")):
-        logger.info(f"RM inference step {step}/{len(dataloader)}")
-
-        rewards_chosen = reward_pipe(batch["text_chosen"], **reward_pipeline_kwargs)
-        rewards_rejected = reward_pipe(batch["text_rejected"], **reward_pipeline_kwargs)
-
-        # for each item in batch, record 1 if chosen > rejected
-        # extra score from dict within batched results (e.g. logits)
-        # [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
-        if isinstance(rewards_chosen[0], dict):
-            score_chosen_batch = [result["score"] for result in rewards_chosen]
-            score_rejected_batch = [result["score"] for result in rewards_rejected]
-        # for classes that directly output scores (custom code)
-        else:
-            score_chosen_batch = rewards_chosen.cpu().numpy().tolist()
-            score_rejected_batch = rewards_rejected.cpu().numpy().tolist()
-
-        # log results
-        [
-            results.append(1) if chosen > rejected else results.append(0)
-            for chosen, rejected in zip(score_chosen_batch, score_rejected_batch)
-        ]
-        scores_chosen.extend(score_chosen_batch)
-        scores_rejected.extend(score_rejected_batch)
+    # accuracy is tallied incrementally; per-example scores are only kept for --save_all
+    num_correct = torch.zeros((), dtype=torch.long, device=accelerator.device)
+    num_total = 0
+    if args.save_all:
+        indices = []
+        scores_chosen = []
+        scores_rejected = []
+    with torch.inference_mode():
+        for step, batch in enumerate(tqdm(dataloader, desc="RM batch steps")):
+            logger.info(f"RM inference step {step}/{len(dataloader)}")
+
+            num_chosen = len(batch["text_chosen"])
+            # RewardBenchPipeline takes the pre-tokenized inputs, other pipelines re-tokenize the texts
+            if isinstance(reward_pipe, RewardBenchPipeline):
+                rewards = reward_pipe(batch["inputs"], **reward_pipeline_kwargs)
+            else:
+                rewards = reward_pipe(batch["text_chosen"] + batch["text_rejected"], **reward_pipeline_kwargs)
+
+            # for each item in batch, count it as correct if chosen > rejected
+            # extra score from dict within batched results (e.g. logits)
+            # [{'label': 'LABEL_1', 'score': 0.6826171875},... ]
+            if isinstance(rewards[0], dict):
+                scores = torch.tensor(
+                    [result["score"] for result in rewards], dtype=torch.float64, device=accelerator.device
+                )
+            # for classes that directly output scores (RewardBenchPipeline, custom code),
+            # keep the logits on device; they only reach the CPU for --save_all
+            # (one score per row: the first logit, as the previous row-wise list comparison used)
+            else:
+                scores = rewards.float().reshape(len(rewards), -1)[:, 0].to(accelerator.device, torch.float64)
+
+            # collect the shards of every process (dropping the duplicates padding the last batch)
+            index_batch, score_chosen_batch, score_rejected_batch = accelerator.gather_for_metrics(
+                (batch["index"], scores[:num_chosen], scores[num_chosen:])
+            )
+
+            # log results (counted on device, synchronized once after the loop)
+            num_correct += (score_chosen_batch > score_rejected_batch).sum()
+            num_total += len(index_batch)
+            if args.save_all:
+                indices.extend(index_batch.tolist())
+                scores_chosen.extend(score_chosen_batch.tolist())
+                scores_rejected.extend(score_rejected_batch.tolist())
+
+    if args.save_all:
+        # restore the original dataset order
+        restore_order = np.argsort(indices)
+        scores_chosen = [scores_chosen[i] for i in restore_order]
+        scores_rejected = [scores_rejected[i] for i in restore_order]
 
     ############################
     # compile scores
     ############################
     # calculate accuracy
-    accuracy = sum(results) / len(results)
-    logger.info(f"Results: {accuracy}, on {len(results)} prompts")
+    accuracy = num_correct.item() / num_total
+    logger.info(f"Results: {accuracy}, on {num_total} prompts")
+
+    # every process holds the gathered results, so only the main process writes them
+    if not accelerator.is_main_process:
+        return
 
     ############################
     # compile scores
     ############################
-    # save score in json to args.output_dir + args.model + ".json"
-    output_path = args.output_dir + args.model + ".json"
-    dirname = os.path.dirname(output_path)
-    os.makedirs(dirname, exist_ok=True)
-
-    # remove old data
-    if os.path.exists(output_path):
-        os.remove(output_path)
-
-    with open(output_path, "w") as f:
-        json.dump(
+    # save score in json to args.output_dir / "<model with / replaced by __>.json"
+    # each file is written to a temporary sibling and renamed into place, so an interrupted
+    # run never leaves a truncated result behind
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    model_name = args.model.replace("/", "__")
+
+    output_path = output_dir / f"{model_name}.json"
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    tmp_path.write_bytes(
+        _json_dumps(
             {
                 "accuracy": accuracy,
-                "num_prompts": len(results),
+                "num_prompts": num_total,
                 "model": args.model,
                 "tokenizer": tokenizer_path,
                 "chat_template": args.chat_template,
-            },
-            f,
+            }
         )
+    )
+    os.replace(tmp_path, output_path)
 
     # if save_all is passed, save a large jsonl with all scores_chosen, scores_rejected
     if args.save_all:
-        output_path = args.output_dir + args.model + "_all.jsonl"
-        dirname = os.path.dirname(output_path)
-        os.makedirs(dirname, exist_ok=True)
-
-        # remove old data
-        if os.path.exists(output_path):
-            os.remove(output_path)
-
-        with open(output_path, "w") as f:
+        output_path = output_dir / f"{model_name}_all.jsonl"
+        tmp_path = output_path.with_name(output_path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
             for chosen, rejected in zip(scores_chosen, scores_rejected):
-                f.write(json.dumps({"chosen": scores_chosen, "rejected": scores_rejected}) + "\n")
+                f.write(_json_dumps({"chosen": chosen, "rejected": rejected}))
+                f.write(b"\n")
+        os.replace(tmp_path, output_path)
 
 
 if __name__ == "__main__":
@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections.abc import Mapping
+
 import torch
+from transformers import BatchEncoding
 
 
 # should be redundant, but having determinism issues
@@ -34,14 +37,18 @@ class RewardBenchPipeline:
         truncation = kwargs.get("truncation", True)
         padding = kwargs.get("padding", True)
         max_length = kwargs.get("max_length", 2048)
-        inputs = self.tokenizer(
-            samples,
-            truncation=truncation,
-            max_length=max_length,
-            padding=padding,
-            # return_special_tokens_mask=True,
-            return_tensors="pt",
-        ).to("cuda")
+        # samples may already be tokenized and padded (e.g. by a DataLoader collate_fn)
+        if isinstance(samples, Mapping):
+            inputs = BatchEncoding(dict(samples)).to("cuda")
+        else:
+            inputs = self.tokenizer(
+                samples,
+                truncation=truncation,
+                max_length=max_length,
+                padding=padding,
+                # return_special_tokens_mask=True,
+                return_tensors="pt",
+            ).to("cuda")
 
         # if tokenizer.bos_token exists, check if there is a double bos token to start the inputs
         # if so, we'll remove the first one and pass in the inputs (somewhat hacky solution)